@@ -2,14 +2,16 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import base64
-import configparser
+import binascii
+import functools
 import logging
 import os
 import re
 import shutil
 import subprocess
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from kolibri.core.content.models import ChannelMetadata
@@ -17,6 +19,8 @@ from kolibri.dist.django.utils.functional import cached_property
 from PIL import Image
 from PIL import ImageDraw
 
+from .key_file_utils import format_key_file_group
+from .key_file_utils import read_key_file_group
 from .path_utils import ensure_dir
 from .path_utils import get_content_share_dir_path
 from .path_utils import get_kolibri_gnome_path
@@ -34,9 +38,7 @@ try:
 except ImportError:
     DISPATCH_URI_SCHEME = "x-kolibri-dispatch"
 
-DATA_URI_PATTERN = re.compile(
-    "^(data:)(?P<mimetype>[\\w\\/\\+-]*)(;base64),(?P<data_b64>.*)"
-)
+DATA_URI_HEADER_PATTERN = re.compile("data:(?P<mimetype>[\\w\\/\\+-]*);base64")
 
 LAUNCHER_CATEGORIES = ("Education", "X-Kolibri-Channel")
 
@@ -51,6 +53,10 @@ CHANNEL_SEARCH_PROVIDER_OBJECT_PATH_FORMAT = (
     KOLIBRI_SEARCH_PROVIDER_OBJECT_PATH + "/channel_{}"
 )
 
+_icon_cache_lock = threading.Lock()
+_icon_cache_running = False
+_icon_cache_pending_params = None
+
 
 def update_channel_launchers(force=False):
     context = ChannelLaunchersContext()
@@ -58,23 +64,39 @@ def update_channel_launchers(force=False):
     launchers_from_db = list(ChannelLauncher_FromDatabase.load_all(context))
     launchers_from_disk = list(ChannelLauncher_FromDisk.load_all(context))
 
+    # Launchers are the same if they have the same desktop file path and
+    # channel id. Desktop file paths are unique on both sides, so each
+    # launcher can only match the launcher with its own path.
+    launchers_from_db_by_path = {
+        launcher.desktop_file_path: launcher for launcher in launchers_from_db
+    }
+    launchers_from_disk_by_path = {
+        launcher.desktop_file_path: launcher for launcher in launchers_from_disk
+    }
+
     did_icons_change = False
 
     for launcher in launchers_from_disk:
-        if not any(map(launcher.is_same_channel, launchers_from_db)):
+        launcher_from_db = launchers_from_db_by_path.get(launcher.desktop_file_path)
+        if not launcher_from_db or not launcher.is_same_channel(launcher_from_db):
             logger.info("Removing desktop launcher %s", launcher)
             launcher.delete()
             did_icons_change = True
 
+    launchers_to_save = []
+
     for launcher in launchers_from_db:
-        if not any(map(launcher.is_same_channel, launchers_from_disk)):
+        launcher_from_disk = launchers_from_disk_by_path.get(launcher.desktop_file_path)
+        if not launcher_from_disk or not launcher.is_same_channel(launcher_from_disk):
             logger.info("Creating desktop launcher %s", launcher)
-            launcher.save()
-            did_icons_change = True
-        elif force or any(map(launcher.compare, launchers_from_disk)):
+            launchers_to_save.append(launcher)
+        elif force or launcher.compare(launcher_from_disk):
             logger.info("Updating desktop launcher %s", launcher)
-            launcher.save()
-            did_icons_change = True
+            launchers_to_save.append(launcher)
+
+    if launchers_to_save:
+        save_channel_launchers(launchers_to_save)
+        did_icons_change = True
 
     if did_icons_change:
         update_icon_cache_params = [context.icon_theme_dir]
@@ -86,24 +108,92 @@ def update_channel_launchers(force=False):
         except OSError:
             update_icon_cache_params += ["--ignore-theme-index"]
 
-        try:
-            subprocess.run(["gtk-update-icon-cache", *update_icon_cache_params])
-        except OSError as error:
-            logger.info("Error running gtk-update-icon-cache: %s", error)
+        update_icon_cache(update_icon_cache_params)
+
+
+def update_icon_cache(update_icon_cache_params):
+    # The icon cache is only an optimization for icon lookups, so there is no
+    # need to wait for it to be updated. Only one gtk-update-icon-cache runs
+    # at a time. If icons change while it is running, it runs once more after
+    # it finishes.
+    global _icon_cache_running, _icon_cache_pending_params
+
+    with _icon_cache_lock:
+        if _icon_cache_running:
+            _icon_cache_pending_params = update_icon_cache_params
+            return
+        process = _start_icon_cache_process(update_icon_cache_params)
+        if not process:
+            return
+        _icon_cache_running = True
+
+    threading.Thread(
+        target=_wait_for_icon_cache_process, args=(process,), daemon=True
+    ).start()
+
+
+def _start_icon_cache_process(update_icon_cache_params):
+    try:
+        return subprocess.Popen(
+            ["gtk-update-icon-cache", "--quiet", *update_icon_cache_params],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as error:
+        logger.info("Error running gtk-update-icon-cache: %s", error)
+        return None
+
+
+def _wait_for_icon_cache_process(process):
+    global _icon_cache_running, _icon_cache_pending_params
+
+    while process:
+        process.wait()
+        with _icon_cache_lock:
+            update_icon_cache_params = _icon_cache_pending_params
+            _icon_cache_pending_params = None
+            if update_icon_cache_params:
+                process = _start_icon_cache_process(update_icon_cache_params)
+            else:
+                process = None
+            _icon_cache_running = process is not None
+
+
+def save_channel_launchers(launchers):
+    # Most of the time spent saving a launcher is in writing its icon, and
+    # Pillow releases the GIL while it decodes, resizes and encodes images, so
+    # icons are written in parallel threads. Everything else, including
+    # reading thumbnails from the database, stays in the calling thread. Each
+    # thread holds a decoded thumbnail and its icon while it writes the icon,
+    # so only a few are used. That only limits the memory used while decoding:
+    # the encoded thumbnail of every channel that is saved stays loaded on its
+    # ChannelMetadata until the update is finished.
+    max_workers = min(len(launchers), os.cpu_count() or 1, 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        icon_name_futures = [
+            executor.submit(launcher.save_channel_icon, launcher.get_channel_icon())
+            for launcher in launchers
+        ]
+        for launcher, icon_name_future in zip(launchers, icon_name_futures):
+            launcher.save_launcher_files(icon_name_future.result())
 
 
 class ChannelLaunchersContext(object):
-    @property
+    # A context is created for each update, so the paths it provides are only
+    # computed once per update.
+
+    @cached_property
     def applications_dir(self):
         return os.path.join(get_content_share_dir_path(), "applications")
 
-    @property
+    @cached_property
     def search_providers_dir(self):
         return os.path.join(
             get_content_share_dir_path(), "gnome-shell", "search-providers"
         )
 
-    @property
+    @cached_property
     def icon_theme_dir(self):
         return os.path.join(get_content_share_dir_path(), "icons", "hicolor")
 
@@ -162,14 +252,24 @@ class ChannelLauncher(object):
         )
 
     def save(self):
+        icon_name = self.save_channel_icon(self.get_channel_icon())
+        self.save_launcher_files(icon_name)
+
+    def get_channel_icon(self):
+        return None
+
+    def save_channel_icon(self, channel_icon):
+        # This may be called from a worker thread, so it must not use the
+        # database.
         try:
-            icon_name = self.write_channel_icon()
+            return self.write_channel_icon(channel_icon)
         except Exception as error:
             logger.warning(
                 "Error writing icon file for channel %s: %s", self.channel_id, error
             )
-            icon_name = None
+            return None
 
+    def save_launcher_files(self, icon_name):
         try:
             self.write_desktop_file(icon_name)
         except Exception as error:
@@ -203,7 +303,7 @@ class ChannelLauncher(object):
     def delete_search_provider(self):
         try_remove(self.search_provider_file_path)
 
-    def write_channel_icon(self):
+    def write_channel_icon(self, channel_icon):
         raise NotImplementedError()
 
     def delete_channel_icon(self):
@@ -219,7 +319,12 @@ class ChannelLauncher_FromDatabase(ChannelLauncher):
 
     @classmethod
     def load_all(cls, context):
-        for channelmetadata in ChannelMetadata.objects.filter(root__available=True):
+        # Thumbnails are large, so they are only loaded for the channels
+        # whose icons need to be written.
+        channelmetadata_queryset = ChannelMetadata.objects.filter(
+            root__available=True
+        ).only("id", "version", "name", "tagline")
+        for channelmetadata in channelmetadata_queryset.iterator():
             yield cls(context, channelmetadata)
 
     @property
@@ -230,6 +335,15 @@ class ChannelLauncher_FromDatabase(ChannelLauncher):
     def channel_version(self):
         return "{}~{}".format(self.__channelmetadata.version, self.FORMAT_VERSION)
 
+    def get_channel_icon(self):
+        try:
+            return self.__channel_icon
+        except Exception as error:
+            logger.warning(
+                "Error reading thumbnail for channel %s: %s", self.channel_id, error
+            )
+            return None
+
     @cached_property
     def __channel_icon(self):
         try:
@@ -238,85 +352,73 @@ class ChannelLauncher_FromDatabase(ChannelLauncher):
             return None
 
     def write_desktop_file(self, icon_name):
-        desktop_file_parser = configparser.ConfigParser()
-        desktop_file_parser.optionxform = str
-        desktop_file_parser.add_section("Desktop Entry")
-        desktop_file_parser.set("Desktop Entry", "Version", "1.0")
-        desktop_file_parser.set("Desktop Entry", "Type", "Application")
-        desktop_file_parser.set("Desktop Entry", "Name", self.__channelmetadata.name)
-        desktop_file_parser.set(
-            "Desktop Entry", "Comment", self.__channelmetadata.tagline or ""
-        )
-        desktop_file_parser.set(
-            "Desktop Entry",
-            "Exec",
-            "gio open {dispatch_uri_scheme}://{channel_id}".format(
-                dispatch_uri_scheme=DISPATCH_URI_SCHEME,
-                channel_id=self.channel_id
+        desktop_entry = [
+            ("Version", "1.0"),
+            ("Type", "Application"),
+            ("Name", self.__channelmetadata.name),
+            ("Comment", self.__channelmetadata.tagline or ""),
+            (
+                "Exec",
+                "gio open {dispatch_uri_scheme}://{channel_id}".format(
+                    dispatch_uri_scheme=DISPATCH_URI_SCHEME,
+                    channel_id=self.channel_id,
+                ),
             ),
-        )
-        desktop_file_parser.set("Desktop Entry", "X-Endless-LaunchMaximized", "True")
-        desktop_file_parser.set(
-            "Desktop Entry", "X-Kolibri-Channel-Id", self.channel_id
-        )
-        desktop_file_parser.set(
-            "Desktop Entry", "X-Kolibri-Channel-Version", self.channel_version
-        )
-        desktop_file_parser.set(
-            "Desktop Entry", "Categories", ";".join(LAUNCHER_CATEGORIES) + ";"
-        )
+            ("X-Endless-LaunchMaximized", "True"),
+            ("X-Kolibri-Channel-Id", self.channel_id),
+            ("X-Kolibri-Channel-Version", self.channel_version),
+            ("Categories", ";".join(LAUNCHER_CATEGORIES) + ";"),
+        ]
 
         if icon_name:
-            desktop_file_parser.set("Desktop Entry", "Icon", icon_name)
+            desktop_entry.append(("Icon", icon_name))
 
         kolibri_gnome = get_kolibri_gnome_path()
         if kolibri_gnome:
-            desktop_file_parser.set("Desktop Entry", "TryExec", kolibri_gnome)
+            desktop_entry.append(("TryExec", kolibri_gnome))
 
         ensure_dir(self.desktop_file_path)
         with open(self.desktop_file_path, "w") as desktop_entry_file:
-            desktop_file_parser.write(desktop_entry_file, space_around_delimiters=False)
+            desktop_entry_file.write(
+                format_key_file_group("Desktop Entry", desktop_entry)
+            )
 
     def write_search_provider(self):
-        search_provider_file_parser = configparser.ConfigParser()
-        search_provider_file_parser.optionxform = str
-        search_provider_file_parser.add_section("Shell Search Provider")
-        search_provider_file_parser.set(
-            "Shell Search Provider", "DesktopId", self.desktop_file_name
-        )
-        search_provider_file_parser.set(
-            "Shell Search Provider", "BusName", KOLIBRI_SEARCH_PROVIDER_BUS_NAME
-        )
-        search_provider_file_parser.set(
-            "Shell Search Provider",
-            "ObjectPath",
-            CHANNEL_SEARCH_PROVIDER_OBJECT_PATH_FORMAT.format(self.channel_id),
-        )
-        search_provider_file_parser.set("Shell Search Provider", "Version", "2")
+        search_provider = [
+            ("DesktopId", self.desktop_file_name),
+            ("BusName", KOLIBRI_SEARCH_PROVIDER_BUS_NAME),
+            (
+                "ObjectPath",
+                CHANNEL_SEARCH_PROVIDER_OBJECT_PATH_FORMAT.format(self.channel_id),
+            ),
+            ("Version", "2"),
+        ]
 
         ensure_dir(self.search_provider_file_path)
         with open(self.search_provider_file_path, "w") as search_provider_file:
-            search_provider_file_parser.write(
-                search_provider_file, space_around_delimiters=False
+            search_provider_file.write(
+                format_key_file_group("Shell Search Provider", search_provider)
             )
 
-    def write_channel_icon(self):
-        if not self.__channel_icon:
+    def write_channel_icon(self, channel_icon):
+        if not channel_icon:
             return
 
         icon_name = self.desktop_id
         icon_file_path = self.get_icon_file_path(
-            icon_name + self.__channel_icon.file_extension
+            icon_name + channel_icon.file_extension
         )
 
         ensure_dir(icon_file_path)
         with open(icon_file_path, "wb") as icon_file:
-            self.__channel_icon.write(icon_file)
+            channel_icon.write(icon_file)
 
         return icon_name
 
 
 class ChannelLauncher_FromDisk(ChannelLauncher):
+    DESKTOP_ENTRY_KEYS = ("X-Kolibri-Channel-Id", "X-Kolibri-Channel-Version", "Icon")
+
     def __init__(self, context, desktop_file_path, desktop_entry_data):
         super().__init__(context)
         self.__desktop_file_path = desktop_file_path
@@ -324,19 +426,22 @@ class ChannelLauncher_FromDisk(ChannelLauncher):
 
     @classmethod
     def load_all(cls, context):
-        applications_dir = os.path.join(get_content_share_dir_path(), "applications")
+        applications_dir = context.applications_dir
         if not os.path.isdir(applications_dir):
             return
-        for file_name in os.listdir(applications_dir):
-            file_path = os.path.join(applications_dir, file_name)
-            desktop_file_parser = configparser.ConfigParser()
-            desktop_file_parser.optionxform = str
-            desktop_file_parser.read(file_path)
-            if desktop_file_parser.has_section("Desktop Entry"):
-                desktop_entry_data = dict(
-                    desktop_file_parser.items(section="Desktop Entry")
-                )
-                yield cls(context, file_path, desktop_entry_data)
+        with os.scandir(applications_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if not dir_entry.name.endswith(".desktop") or not dir_entry.is_file():
+                    continue
+                try:
+                    with open(dir_entry.path, "r") as desktop_entry_file:
+                        desktop_entry_data = read_key_file_group(
+                            desktop_entry_file, "Desktop Entry", cls.DESKTOP_ENTRY_KEYS
+                        )
+                except (OSError, UnicodeDecodeError):
+                    continue
+                if desktop_entry_data is not None:
+                    yield cls(context, dir_entry.path, desktop_entry_data)
 
     @property
     def channel_id(self):
@@ -354,7 +459,7 @@ class ChannelLauncher_FromDisk(ChannelLauncher):
     def desktop_file_name(self):
         return os.path.basename(self.desktop_file_path)
 
-    def write_channel_icon(self):
+    def write_channel_icon(self, channel_icon):
         pass
 
     def delete_channel_icon(self):
@@ -373,64 +478,88 @@ class ChannelLauncher_FromDisk(ChannelLauncher):
 class ChannelIcon(object):
     MIMETYPES_MAP = {"image/jpg": "image/jpeg"}
 
+    # A lower compression level than zlib's default makes writing icons much
+    # faster, and barely affects the size of a 256x256 PNG.
+    PNG_COMPRESS_LEVEL = 3
+
     icon_size = (256, 256)
     icon_inner_size = (256 - 48, 256 - 48)
 
     def __init__(self, thumbnail_data_uri):
-        match = DATA_URI_PATTERN.match(thumbnail_data_uri)
-        if not match:
+        # Only the header is matched against a pattern, because the data may
+        # be very long. For the same reason, the data is not copied out of the
+        # data URI until it is decoded.
+        data_start = thumbnail_data_uri.find(",")
+        match = DATA_URI_HEADER_PATTERN.fullmatch(thumbnail_data_uri, 0, data_start)
+        if data_start < 0 or not match:
             raise ValueError("Invalid data URI")
         self.__thumbnail_info = match.groupdict()
+        self.__thumbnail_data_uri = thumbnail_data_uri
+        self.__thumbnail_data_start = data_start + 1
 
     @property
     def mimetype(self):
         result = self.__thumbnail_info.get("mimetype")
         return self.MIMETYPES_MAP.get(result, result)
 
-    @cached_property
+    @property
     def thumbnail_data(self):
-        return base64.b64decode(self.__thumbnail_info.get("data_b64"))
+        # binascii reads an ASCII string in place, where base64.b64decode would
+        # first encode a copy of it to bytes.
+        return binascii.a2b_base64(
+            self.__thumbnail_data_uri[self.__thumbnail_data_start :]
+        )
 
     @cached_property
     def file_extension(self):
         return ".png"
 
-    @cached_property
+    @property
     def thumbnail_image(self):
-        thumbnail_io = BytesIO(self.thumbnail_data)
-        return Image.open(thumbnail_io)
+        # Decode the image immediately so the decoded thumbnail data does not
+        # need to be kept around while the image is in use. BytesIO shares the
+        # buffer of the bytes object it is given, so this does not copy it.
+        image = Image.open(BytesIO(self.thumbnail_data))
+        image.load()
+        return image
 
-    @cached_property
+    @property
     def icon_image(self):
-        return self.__apply_icon_mask(self.__icon_inner_default_image)
+        # None of the images are cached, so an icon is only held in memory
+        # while it is being written.
+        source_image = self.__get_icon_source_image()
+        return self.__apply_icon_mask(self.__get_icon_inner_default_image(source_image))
 
     def write(self, icon_file):
-        self.icon_image.save(icon_file)
+        self.icon_image.save(
+            icon_file,
+            format="PNG",
+            compress_level=self.PNG_COMPRESS_LEVEL,
+            optimize=False,
+        )
 
-    @cached_property
-    def __icon_source_image(self):
+    def __get_icon_source_image(self):
         # The icon source image is the thumbnail, cropped to remove its own
         # padding, and cropped again to square if the icon is close to square
         # already.
 
-        bbox = self.thumbnail_image.getbbox()
-        image_cropped = self.thumbnail_image.crop(bbox)
+        thumbnail_image = self.thumbnail_image
+        bbox = thumbnail_image.getbbox()
+        image_cropped = thumbnail_image.crop(bbox)
         return crop_image_to_square(image_cropped, cut_area=0.04)
 
-    @cached_property
-    def __icon_inner_fill_image(self):
+    def __get_icon_inner_fill_image(self, source_image):
         # The "fill" icon variant resizes the source image to icon_inner_size.
         # The corners will be rounded, later, by __apply_icon_mask.
 
         base_image = Image.new("RGBA", self.icon_inner_size, (0, 0, 0, 0))
         thumbnail_image = resize_preserving_aspect_ratio(
-            self.__icon_source_image, self.icon_inner_size, resample=Image.BICUBIC
+            source_image, self.icon_inner_size
         )
         paste_center(base_image, thumbnail_image)
         return base_image
 
-    @cached_property
-    def __icon_inner_tile_image(self):
+    def __get_icon_inner_tile_image(self, source_image):
         # The "tile" icon variant resizes the source image to a smaller space
         # inside icon_inner_size. The remaining space is filled with a white
         # background.
@@ -438,47 +567,56 @@ class ChannelIcon(object):
         thumbnail_size = (256 - 80, 256 - 80)
 
         base_image = Image.new("RGBA", self.icon_inner_size, (255, 255, 255, 255))
-        thumbnail_image = resize_preserving_aspect_ratio(
-            self.__icon_source_image, thumbnail_size, resample=Image.BICUBIC
-        )
+        thumbnail_image = resize_preserving_aspect_ratio(source_image, thumbnail_size)
         paste_center(base_image, thumbnail_image)
         return base_image
 
-    @cached_property
-    def __icon_inner_default_image(self):
+    def __get_icon_inner_default_image(self, source_image):
         # The default icon variant is the "fill" variant if it is exactly
         # square with no transparent pixels. Otherwise, it is the "tile"
         # variant.
 
-        if image_is_square(self.__icon_inner_fill_image):
-            return self.__icon_inner_fill_image
+        fill_image = self.__get_icon_inner_fill_image(source_image)
+        if image_is_square(fill_image):
+            return fill_image
         else:
-            return self.__icon_inner_tile_image
+            return self.__get_icon_inner_tile_image(source_image)
 
     def __apply_icon_mask(self, icon_image):
-        # The icon mask is a rounded rectangle matching the GNOME icon set.
-
-        shadow_size = (256 - 50, 256 - 50)
-        plate_size = (256 - 52, 256 - 52)
-
-        base_mask = Image.new("L", self.icon_size, (0,))
-        base_mask_draw = ImageDraw.Draw(base_mask)
-        base_mask_draw.rounded_rectangle(
-            center_xy(base_mask.size, shadow_size),
-            14,
-            fill=(200,),
-            width=1,
-        )
-        base_mask_draw.rounded_rectangle(
-            center_xy(base_mask.size, plate_size),
-            14,
-            fill=(255,),
-            outline=(255,),
-            width=1,
-        )
+        base_mask = _get_icon_mask(self.icon_size)
 
+        # The mask replaces the alpha channel entirely, so the icon can be
+        # pasted as it is instead of being composited over the base image.
         base_image = Image.new("RGBA", self.icon_size, (0, 0, 0, 0))
-        paste_center(base_image, icon_image)
+        base_image.paste(icon_image, center_xy(self.icon_size, icon_image.size))
         base_image.putalpha(base_mask)
 
         return base_image
+
+
+@functools.lru_cache(maxsize=1)
+def _get_icon_mask(icon_size):
+    # The icon mask is a rounded rectangle matching the GNOME icon set. It is
+    # the same for every channel, so it is only drawn once. Callers must not
+    # modify the returned image.
+
+    shadow_size = (256 - 50, 256 - 50)
+    plate_size = (256 - 52, 256 - 52)
+
+    base_mask = Image.new("L", icon_size, (0,))
+    base_mask_draw = ImageDraw.Draw(base_mask)
+    base_mask_draw.rounded_rectangle(
+        center_xy(base_mask.size, shadow_size),
+        14,
+        fill=(200,),
+        width=1,
+    )
+    base_mask_draw.rounded_rectangle(
+        center_xy(base_mask.size, plate_size),
+        14,
+        fill=(255,),
+        outline=(255,),
+        width=1,
+    )
+
+    return base_mask
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+KEY_FILE_ESCAPES = str.maketrans({"\\": "\\\\", "\n": "\\n", "\t": "\\t", "\r": "\\r"})
+
+
+def escape_key_file_value(value):
+    """
+    Escapes a string for use as a value in a desktop entry style key file, as
+    described in the Desktop Entry Specification.
+    """
+    return value.translate(KEY_FILE_ESCAPES)
+
+
+def format_key_file_group(group_name, entries):
+    """
+    Returns the contents of a key file with a single group, in the same format
+    that ConfigParser writes with space_around_delimiters=False.
+    """
+    lines = ["[{}]\n".format(group_name)]
+    lines.extend(
+        "{}={}\n".format(key, escape_key_file_value(value)) for key, value in entries
+    )
+    lines.append("\n")
+    return "".join(lines)
+
+
+def read_key_file_group(key_file, group_name, keys):
+    """
+    Reads the given keys from a key file which starts with the group named
+    group_name. Reading stops as soon as all of the keys have been found, or at
+    the end of the group. Returns None if the file does not start with that
+    group.
+    """
+    group_header = "[{}]".format(group_name)
+    in_group = False
+    values = {}
+
+    for line in key_file:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        elif line.startswith("["):
+            if in_group or line != group_header:
+                break
+            in_group = True
+        elif not in_group:
+            break
+        else:
+            key, sep, value = line.partition("=")
+            key = key.strip()
+            if sep and key in keys:
+                values[key] = value.strip()
+                if len(values) == len(keys):
+                    break
+
+    return values if in_group else None
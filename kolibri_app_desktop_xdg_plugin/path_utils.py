@@ -18,8 +18,7 @@ def get_content_share_dir_path():
 
 def ensure_dir(file_path):
     dir_path = os.path.dirname(file_path)
-    if not os.path.isdir(dir_path):
-        os.makedirs(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
     return file_path
 
 